@@ -13,122 +13,86 @@
 # limitations under the License.
 
 import argparse
+import asyncio
+import collections
 import datetime
+import hashlib
+import itertools
 import json
+import os
+import shelve
 import sys
+import time
 
+import httpx
 import keyring
-import requests
-
-
-class AuthorCounts:
-    def __init__(self):
-        self.total_commits = 0
-        self.commits_in_last_year = 0
-        self.total_reviews = 0
-        self.reviews_in_last_year = 0
-
-
-def get_commits(key, organization, repo_name, branch_name):
-    history_args = ''
-
-    bearer = 'Bearer %s' % key
-    headers = {'Authorization': bearer}
-
-    commits = []
-    while True:
-        query = '''
-{
-  repository(name: "%s", owner: "%s") {
-    ref(qualifiedName: "%s") {
+import orjson
+
+# GitHub's secondary rate limits penalize clients that make too many
+# concurrent requests, so bound the number of in-flight queries.
+MAX_CONCURRENT_REQUESTS = 10
+# The number of repositories whose data is fetched in a single GraphQL query.
+REPOS_PER_QUERY = 10
+# Query responses are cached on disk so that history which has already
+# been downloaded does not have to be fetched again on the next run.  Pages
+# which may still change are only reused for this many seconds.
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'github-org-contributions')
+CACHE_TTL = 60 * 60
+# Entries that have not been used for this many seconds are dropped.  Until
+# then stale pages with an ETag can be revalidated with If-None-Match instead
+# of being fetched again.
+CACHE_EXPIRY = 7 * 24 * 60 * 60
+# Going through the whole cache is slow, so only prune it this often.
+CACHE_PRUNE_INTERVAL = 24 * 60 * 60
+
+
+# All of the values in the queries are passed as GraphQL variables, so the
+# text of a query stays the same from page to page and only the cursors in the
+# variables change.  The batched subqueries are repeated once per repository,
+# with their variables prefixed by the alias of that repository.
+COMMITS_SHARED_VARIABLES = '$owner: String!, $since: GitTimestamp'
+COMMITS_VARIABLES = '$%(alias)sName: String!, $%(alias)sRef: String!, $%(alias)sAfter: String'
+COMMITS_SUBQUERY = '''
+  %(alias)s: repository(name: $%(alias)sName, owner: $owner) {
+    ref(qualifiedName: $%(alias)sRef) {
       target {
         ... on Commit {
-          id
-          history(first: 100%s) {
+          history(first: 100, after: $%(alias)sAfter, since: $since) {
             pageInfo {
               hasNextPage
               endCursor
             }
-            edges {
-              node {
-                author {
-                  name
-                  user {
-                    login
-                  }
+            nodes {
+              author {
+                name
+                user {
+                  login
                 }
-                authoredDate
               }
+              authoredDate
             }
           }
         }
       }
     }
-  }
-}''' % (repo_name, organization, branch_name, history_args)
-
-        request = requests.post('https://api.github.com/graphql', json={'query': query}, headers=headers)
-        if request.status_code != 200:
-            raise Exception('GitHub GraphQL query failed with code {}.'.format(request.status_code))
-        result = request.json()
-        if not 'data' in result:
-            raise Exception('GraphQL query returned unexpected data: %s' % (result))
-        if not 'repository' in result['data'] or result['data']['repository'] is None:
-            raise Exception('Repo https://github.com/{}/{} does not exist'.format(organization, repo_name))
-        if not 'ref' in result['data']['repository'] or result['data']['repository']['ref'] is None:
-            raise Exception('Repo https://github.com/{}/{} does not exist'.format(organization, repo_name))
-        history = result['data']['repository']['ref']['target']['history']
-
-        for edge in history['edges']:
-            node = edge['node']
-            if node['author']['user'] is not None:
-                author = node['author']['user']['login']
-            else:
-                # It may be the case that GitHub can't match the author name
-                # back to a GitHub account.  This can happen if the email
-                # address in the commit doesn't match one that they have on
-                # file for that committer.  In these cases, just take the author
-                # name on the commit and use that.
-                author = node['author']['name']
-            commits.append({
-                'author': author,
-                'authoredDate': datetime.datetime.strptime(
-                    node['authoredDate'], '%Y-%m-%dT%H:%M:%SZ').timestamp(),
-            })
-
-        if not history['pageInfo']['hasNextPage']:
-            break
-        history_args = ', after: "%s"' % history['pageInfo']['endCursor']
-
-    return commits
-
-
-def get_reviews(key, org_name, repo_name):
-    pr_history_args = ''
-    review_history_args = ''
-
-    reviewers = []
+  }'''
 
-    bearer = 'Bearer %s' % key
-    headers = {'Authorization': bearer}
-
-    while True:
-        while True:
-            query = '''
-{
-  repository(owner: "%s", name: "%s") {
-    pullRequests(first:100%s) {
+REVIEWS_SHARED_VARIABLES = '$owner: String!, $orderBy: IssueOrder'
+REVIEWS_VARIABLES = '$%(alias)sName: String!, $%(alias)sAfter: String, $%(alias)sReviewsAfter: String'
+REVIEWS_SUBQUERY = '''
+  %(alias)s: repository(owner: $owner, name: $%(alias)sName) {
+    pullRequests(first:100, after: $%(alias)sAfter, orderBy: $orderBy) {
       pageInfo {
         hasNextPage,
         endCursor
       },
       nodes {
         id,
-        number,
         author {
           login
         },
-        reviews(first:100%s) {
+        updatedAt,
+        reviews(first:100, after: $%(alias)sReviewsAfter) {
           pageInfo {
             hasNextPage,
             endCursor
@@ -142,16 +106,239 @@ def get_reviews(key, org_name, repo_name):
         },
       },
     },
+  }'''
+
+ORG_REPOS_QUERY = '''
+query($login: String!, $after: String) {
+  organization(login: $login) {
+    repositories(first:100, after: $after) {
+      pageInfo {
+        hasNextPage,
+        endCursor
+      },
+      nodes {
+        defaultBranchRef {
+          name
+        },
+        name,
+        isArchived
+      }
+    }
   }
-}''' % (org_name, repo_name, pr_history_args, review_history_args)
-
-            request = requests.post('https://api.github.com/graphql', json={'query': query}, headers=headers)
-            if request.status_code != 200:
-                raise Exception('GitHub GraphQL query failed with code {}.'.format(request.status_code))
-            result = request.json()
-            prs = result['data']['repository']['pullRequests']['nodes']
-            review_history_args = ''
-            for pr in prs:
+}'''
+
+
+class AuthorCounts:
+    __slots__ = ('total_commits', 'commits_in_last_year', 'total_reviews', 'reviews_in_last_year')
+
+    def __init__(self):
+        self.total_commits = 0
+        self.commits_in_last_year = 0
+        self.total_reviews = 0
+        self.reviews_in_last_year = 0
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def build_batched_query(shared_variables, variables, subquery, aliases):
+    # GraphQL allows the same field to be queried multiple times in a single
+    # request as long as each one is given a unique alias, so stitch together
+    # one copy of the subquery per repository.
+    return 'query(%s, %s) {%s\n}' % (
+        shared_variables,
+        ', '.join(variables % {'alias': alias} for alias in aliases),
+        ''.join(subquery % {'alias': alias} for alias in aliases))
+
+
+def prune_cache(cache):
+    # Even immutable entries stop being used once the head of any branch in
+    # their batch moves, since all of the history cursors change with it.
+    # Drop anything that has not been used for a while, and stale entries
+    # that cannot be revalidated, rather than letting the cache grow forever.
+    now = time.time()
+    if now - cache.get('last-pruned', 0) < CACHE_PRUNE_INTERVAL:
+        return
+
+    for key in list(cache):
+        if key == 'last-pruned':
+            continue
+        entry = cache[key]
+        if now - entry.get('used', entry['fetched']) >= CACHE_EXPIRY:
+            del cache[key]
+        elif not entry['immutable'] and now - entry['fetched'] >= CACHE_TTL and entry['etag'] is None:
+            del cache[key]
+    cache['last-pruned'] = now
+
+
+async def graphql_query(client, semaphore, cache, query, variables, is_immutable):
+    payload = {'query': query, 'variables': variables}
+    # Different tokens can see different (e.g. private) repositories, so the
+    # token is part of the key and responses are never shared between them.
+    key = hashlib.md5((client.headers['Authorization'] + json.dumps(payload, sort_keys=True)).encode()).hexdigest()
+    headers = {}
+    entry = None
+    if cache is not None and key in cache:
+        entry = cache[key]
+        if entry['immutable']:
+            # Only record the use now and then, since it means writing the
+            # whole entry out again.
+            if time.time() - entry.get('used', entry['fetched']) >= CACHE_TTL:
+                entry['used'] = time.time()
+                cache[key] = entry
+            return orjson.loads(entry['content'])
+        if time.time() - entry['fetched'] < CACHE_TTL:
+            return orjson.loads(entry['content'])
+        # The cached response is stale, so ask GitHub whether it has changed.
+        # A 304 response does not count against the rate limit.
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+
+    async with semaphore:
+        request = await client.post('https://api.github.com/graphql', json=payload, headers=headers)
+    if request.status_code == 304 and entry is not None:
+        entry['fetched'] = time.time()
+        entry['used'] = entry['fetched']
+        cache[key] = entry
+        return orjson.loads(entry['content'])
+    if request.status_code != 200:
+        raise Exception('GitHub GraphQL query failed with code {}.'.format(request.status_code))
+    result = orjson.loads(request.content)
+
+    if cache is not None and 'data' in result and not 'errors' in result:
+        fetched = time.time()
+        cache[key] = {
+            'fetched': fetched,
+            'used': fetched,
+            'immutable': is_immutable(result),
+            'etag': request.headers.get('ETag'),
+            'content': request.content,
+        }
+
+    return result
+
+
+async def get_commits(client, semaphore, cache, organization, repos, since):
+    aliases = {'repo%d' % i: repo for i, repo in enumerate(repos)}
+    # Only repositories that still have more history to fetch are kept here.
+    cursors = {alias: None for alias in aliases}
+
+    query = None
+    while cursors:
+        # The query only needs to be rebuilt when a repository has dropped out.
+        if query is None:
+            query = build_batched_query(COMMITS_SHARED_VARIABLES, COMMITS_VARIABLES, COMMITS_SUBQUERY, cursors)
+        variables = {'owner': organization, 'since': since}
+        for alias, cursor in cursors.items():
+            variables[alias + 'Name'] = aliases[alias][0]
+            variables[alias + 'Ref'] = aliases[alias][1]
+            variables[alias + 'After'] = cursor
+
+        # Every page after the first is relative to a fixed commit, so it will
+        # never change.  That is not worth keeping forever when 'since' is set,
+        # though, since it moves every day and with it the key of every page.
+        immutable = since is None and all(cursor is not None for cursor in cursors.values())
+        result = await graphql_query(client, semaphore, cache, query, variables, lambda result: immutable)
+        if not 'data' in result:
+            raise Exception('GraphQL query returned unexpected data: %s' % (result))
+
+        for alias in list(cursors):
+            repo_name = aliases[alias][0]
+            if not alias in result['data'] or result['data'][alias] is None:
+                raise Exception('Repo https://github.com/{}/{} does not exist'.format(organization, repo_name))
+            if not 'ref' in result['data'][alias] or result['data'][alias]['ref'] is None:
+                raise Exception('Repo https://github.com/{}/{} does not exist'.format(organization, repo_name))
+            history = result['data'][alias]['ref']['target']['history']
+
+            for node in history['nodes']:
+                node_author = node['author']
+                if node_author['user'] is not None:
+                    author = node_author['user']['login']
+                else:
+                    # It may be the case that GitHub can't match the author name
+                    # back to a GitHub account.  This can happen if the email
+                    # address in the commit doesn't match one that they have on
+                    # file for that committer.  In these cases, just take the author
+                    # name on the commit and use that.
+                    author = node_author['name']
+                yield repo_name, author, node['authoredDate']
+
+            if not history['pageInfo']['hasNextPage']:
+                del cursors[alias]
+                query = None
+                continue
+            cursors[alias] = history['pageInfo']['endCursor']
+
+
+async def get_reviews(client, semaphore, cache, org_name, repos, since):
+    # When only recent reviews are wanted, list the most recently updated pull
+    # requests first; submitting a review updates the pull request, so the
+    # pagination can stop at the first one last updated before 'since'.
+    #
+    # The update time can change while we are paginating, though.  A pull
+    # request that is updated meanwhile jumps ahead of the cursor and would be
+    # missed, so once a repository has been walked, go back over the pull
+    # requests updated since the walk started and pick up any that were not
+    # seen.
+    if since is None:
+        order_by = None
+    else:
+        order_by = {'field': 'UPDATED_AT', 'direction': 'DESC'}
+
+    aliases = {'repo%d' % i: repo_name for i, (repo_name, branch_name) in enumerate(repos)}
+    # Only repositories that still have more pull requests to fetch are kept
+    # here.
+    pr_cursors = {alias: None for alias in aliases}
+    review_cursors = {alias: None for alias in aliases}
+    # The pull requests which have been completely counted, the update time of
+    # the newest one when the walk started, and the repositories that are
+    # going back over the ones updated since then.
+    seen_prs = {alias: set() for alias in aliases}
+    walk_started = {}
+    rechecking = set()
+
+    query = None
+    while pr_cursors:
+        # The query only needs to be rebuilt when a repository has dropped out.
+        if query is None:
+            query = build_batched_query(REVIEWS_SHARED_VARIABLES, REVIEWS_VARIABLES, REVIEWS_SUBQUERY, pr_cursors)
+        variables = {'owner': org_name, 'orderBy': order_by}
+        for alias, cursor in pr_cursors.items():
+            variables[alias + 'Name'] = aliases[alias]
+            variables[alias + 'After'] = cursor
+            variables[alias + 'ReviewsAfter'] = review_cursors[alias]
+
+        # Any page of pull requests can change, since older pull requests can
+        # still get new reviews, so these are never cached forever.  Going
+        # back over the recently updated pull requests asks for the same pages
+        # as the start of the walk, so that must not come from the cache.
+        if rechecking.isdisjoint(pr_cursors):
+            page_cache = cache
+        else:
+            page_cache = None
+        result = await graphql_query(client, semaphore, page_cache, query, variables, lambda result: False)
+
+        for alias in list(pr_cursors):
+            repo_name = aliases[alias]
+            pr_history = result['data'][alias]['pullRequests']
+            if order_by is not None and not alias in walk_started:
+                if len(pr_history['nodes']) > 0:
+                    walk_started[alias] = pr_history['nodes'][0]['updatedAt']
+                else:
+                    walk_started[alias] = ''
+            review_cursors[alias] = None
+            for pr in pr_history['nodes']:
+                # Only count each pull request once, even if it moved while we
+                # were paginating.
+                if pr['id'] in seen_prs[alias]:
+                    continue
+
                 # A PR author can be None if the account was deleted.
                 if pr['author'] is None:
                     pr_author = ''
@@ -176,57 +363,40 @@ def get_reviews(key, org_name, repo_name):
                     if review['submittedAt'] is None:
                         continue
 
-                    reviewers.append({
-                        'author': review_author,
-                        'reviewDate': datetime.datetime.strptime(
-                            review['submittedAt'], '%Y-%m-%dT%H:%M:%SZ').timestamp(),
-                    })
+                    yield repo_name, review_author, review['submittedAt']
 
                 if reviews['pageInfo']['hasNextPage']:
-                    review_history_args = ', after: "%s"' % pr['reviews']['pageInfo']['endCursor']
+                    review_cursors[alias] = pr['reviews']['pageInfo']['endCursor']
                     break
 
-            if review_history_args == '':
-                break
-
-        pr_history = result['data']['repository']['pullRequests']
-        if not pr_history['pageInfo']['hasNextPage']:
-            break
-        pr_history_args = ', after: "%s"' % pr_history['pageInfo']['endCursor']
+            if review_cursors[alias] is not None:
+                # There are more reviews to fetch, so query this same page of
+                # pull requests again.
+                continue
 
-    return reviewers
+            seen_prs[alias].update(pr['id'] for pr in pr_history['nodes'])
 
-def get_org_repos_from_name(key, org_name):
-    history_args = ''
+            if alias in rechecking:
+                stop_at = walk_started[alias]
+            else:
+                stop_at = since
+            reached_stop = stop_at is not None and len(pr_history['nodes']) > 0 and pr_history['nodes'][-1]['updatedAt'] < stop_at
+            if reached_stop or not pr_history['pageInfo']['hasNextPage']:
+                if order_by is not None and not alias in rechecking:
+                    rechecking.add(alias)
+                    pr_cursors[alias] = None
+                    continue
+                del pr_cursors[alias]
+                query = None
+                continue
+            pr_cursors[alias] = pr_history['pageInfo']['endCursor']
 
-    bearer = 'Bearer %s' % key
-    headers = {'Authorization': bearer}
+async def get_org_repos_from_name(client, semaphore, cache, org_name):
+    cursor = None
 
     repos = {}
     while True:
-        query = '''
-{
-  organization(login: "%s") {
-    repositories(first:100%s) {
-      pageInfo {
-        hasNextPage,
-        endCursor
-      },
-      nodes {
-        defaultBranchRef {
-          name
-        },
-        name,
-        isArchived
-      }
-    }
-  }
-}''' % (org_name, history_args)
-
-        request = requests.post('https://api.github.com/graphql', json={'query': query}, headers=headers)
-        if request.status_code != 200:
-            raise Exception('GitHub GraphQL query failed with code {}.'.format(request.status_code))
-        result = request.json()
+        result = await graphql_query(client, semaphore, cache, ORG_REPOS_QUERY, {'login': org_name, 'after': cursor}, lambda result: False)
         for repo in result['data']['organization']['repositories']['nodes']:
             repo_name = repo['name']
             if repo['defaultBranchRef'] is None:
@@ -240,55 +410,107 @@ def get_org_repos_from_name(key, org_name):
 
         if not result['data']['organization']['repositories']['pageInfo']['hasNextPage']:
             break
-        history_args = ', after: "%s"' % result['data']['organization']['repositories']['pageInfo']['endCursor']
+        cursor = result['data']['organization']['repositories']['pageInfo']['endCursor']
     return repos
 
-def print_authors(authors, print_totals):
-    sorted_authors = {key: value for key, value in sorted(authors.items(), key=lambda item: item[1].commits_in_last_year + item[1].reviews_in_last_year, reverse=True)}
-
+def print_authors(sorted_authors, print_totals):
     author_with_space = 'Author                    '
     commits_with_space = 'Commits in last year  '
     total_commits_with_space = 'Total commits  '
     reviews_with_space = 'Reviews in last year  '
     total_reviews = 'Total reviews'
 
-    print()
+    lines = ['']
 
     if print_totals:
-        print('%s%s%s%s%s' % (author_with_space, commits_with_space, total_commits_with_space, reviews_with_space, total_reviews))
-        print('-'*(len(author_with_space) + len(commits_with_space) + len(total_commits_with_space) + len(reviews_with_space) + len(total_reviews)))
-        for author,counts in sorted_authors.items():
-            print('%s%s%d%s%d%s%d%s%d' % (author, ' '*(len(author_with_space) - len(author)), counts.commits_in_last_year, ' '*(len(commits_with_space) - len(str(counts.commits_in_last_year))), counts.total_commits, ' '*(len(total_commits_with_space) - len(str(counts.total_commits))), counts.reviews_in_last_year, ' '*(len(reviews_with_space) - len(str(counts.reviews_in_last_year))), counts.total_reviews))
+        lines.append('%s%s%s%s%s' % (author_with_space, commits_with_space, total_commits_with_space, reviews_with_space, total_reviews))
+        lines.append('-'*(len(author_with_space) + len(commits_with_space) + len(total_commits_with_space) + len(reviews_with_space) + len(total_reviews)))
+        row = '{:<%d}{:<%d}{:<%d}{:<%d}{}' % (len(author_with_space), len(commits_with_space), len(total_commits_with_space), len(reviews_with_space))
+        for author,counts in sorted_authors:
+            lines.append(row.format(author, counts.commits_in_last_year, counts.total_commits, counts.reviews_in_last_year, counts.total_reviews))
     else:
         reviews_with_space = reviews_with_space.strip()
-        print('%s%s%s' % (author_with_space, commits_with_space, reviews_with_space))
-        print('-'*(len(author_with_space) + len(commits_with_space) + len(reviews_with_space)))
-        for author,counts in sorted_authors.items():
+        lines.append('%s%s%s' % (author_with_space, commits_with_space, reviews_with_space))
+        lines.append('-'*(len(author_with_space) + len(commits_with_space) + len(reviews_with_space)))
+        row = '{:<%d}{:<%d}{}' % (len(author_with_space), len(commits_with_space))
+        for author,counts in sorted_authors:
             if counts.commits_in_last_year == 0 and counts.reviews_in_last_year == 0:
                 continue
-            print('%s%s%d%s%d' % (author, ' '*(len(author_with_space) - len(author)), counts.commits_in_last_year, ' '*(len(commits_with_space) - len(str(counts.commits_in_last_year))), counts.reviews_in_last_year))
-
-    print()
+            lines.append(row.format(author, counts.commits_in_last_year, counts.reviews_in_last_year))
 
-def print_csv(authors, print_totals):
-    sorted_authors = {key: value for key, value in sorted(authors.items(), key=lambda item: item[1].commits_in_last_year + item[1].reviews_in_last_year, reverse=True)}
+    lines.append('')
+    sys.stdout.write('\n'.join(lines) + '\n')
 
+def print_csv(sorted_authors, print_totals):
     if print_totals:
         print('Author,Commits in last year,Total commits,Reviews in last year,Total reviews,Commits+Reviews in last year,Commits+Reviews total')
-        for author,counts in sorted_authors.items():
-            print('%s,%d,%d,%d,%d' % (author, counts.commits_in_last_year, counts.total_commits, counts.reviews_in_last_year, counts.total_reviews, counts.commits_in_last_year + counts.reviews_in_last_year, counts.total_commits + counts.total_reviews))
+        for author,counts in sorted_authors:
+            print('%s,%d,%d,%d,%d,%d,%d' % (author, counts.commits_in_last_year, counts.total_commits, counts.reviews_in_last_year, counts.total_reviews, counts.commits_in_last_year + counts.reviews_in_last_year, counts.total_commits + counts.total_reviews))
     else:
         print('Author,Commits in last year,Reviews in last year,Commits+Reviews')
-        for author,counts in sorted_authors.items():
+        for author,counts in sorted_authors:
             if counts.commits_in_last_year == 0 and counts.reviews_in_last_year == 0:
                 continue
             print('%s,%d,%d,%d' % (author, counts.commits_in_last_year, counts.reviews_in_last_year, counts.commits_in_last_year + counts.reviews_in_last_year))
     print()
 
+async def count_reviews(client, semaphore, cache, org_name, repos, one_year_ago_iso, since):
+    repos_authors = {repo_name: collections.defaultdict(AuthorCounts) for repo_name, branch in repos}
+    async for repo_name, author, review_date in get_reviews(client, semaphore, cache, org_name, repos, since):
+        counts = repos_authors[repo_name][author]
+        counts.total_reviews += 1
+        if review_date >= one_year_ago_iso:
+            counts.reviews_in_last_year += 1
+
+    return repos_authors
+
+async def count_commits(client, semaphore, cache, org_name, repos, one_year_ago_iso, since):
+    repos_authors = {repo_name: collections.defaultdict(AuthorCounts) for repo_name, branch in repos}
+    async for repo_name, author, authored_date in get_commits(client, semaphore, cache, org_name, repos, since):
+        counts = repos_authors[repo_name][author]
+        counts.total_commits += 1
+        if authored_date >= one_year_ago_iso:
+            counts.commits_in_last_year += 1
+
+    return repos_authors
+
+async def get_repos_authors(client, semaphore, cache, org_name, repos, one_year_ago_iso, since):
+    # The reviews and commits are independent, so fetch them at the same time.
+    repos_authors, repos_committers = await asyncio.gather(
+        count_reviews(client, semaphore, cache, org_name, repos, one_year_ago_iso, since),
+        count_commits(client, semaphore, cache, org_name, repos, one_year_ago_iso, since))
+
+    # Merge the commit counts in after the reviews so that the order of the
+    # authors does not depend on which requests happened to finish first.
+    for repo_name, committers in repos_committers.items():
+        authors = repos_authors[repo_name]
+        for author, counts in committers.items():
+            author_counts = authors[author]
+            author_counts.total_commits = counts.total_commits
+            author_counts.commits_in_last_year = counts.commits_in_last_year
+
+    return repos_authors
+
+async def get_org_authors(key, cache, org_name, one_year_ago_iso, since):
+    headers = {'Authorization': 'Bearer %s' % key}
+    # Keep the connections to api.github.com open so that only the first query
+    # pays for the TCP and TLS handshakes.
+    limits = httpx.Limits(max_connections=MAX_CONCURRENT_REQUESTS, max_keepalive_connections=MAX_CONCURRENT_REQUESTS)
+    async with httpx.AsyncClient(http2=True, timeout=30, headers=headers, limits=limits) as client:
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        org_repos = await get_org_repos_from_name(client, semaphore, cache, org_name)
+        results = await asyncio.gather(*[get_repos_authors(client, semaphore, cache, org_name, repos, one_year_ago_iso, since) for repos in chunked(org_repos.items(), REPOS_PER_QUERY)])
+
+    org_authors = {}
+    for repos_authors in results:
+        org_authors.update(repos_authors)
+    return org_authors
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--show-totals', help='Show the all time stats along with the last year', action='store_true', default=False)
     parser.add_argument('--csv', help='Output the data in CSV format', action='store_true', default=False)
+    parser.add_argument('--no-cache', help='Fetch everything from GitHub instead of using cached query responses', action='store_true', default=False)
     parser.add_argument('org', nargs=1, help='Which GitHub organization to collect statistics for', action='store')
     args = parser.parse_args()
 
@@ -297,36 +519,42 @@ def main():
         raise RuntimeError('Failed to get GitHub API key')
 
     today = datetime.datetime.now()
-    one_year_ago_timestamp = (today - datetime.timedelta(days=365)).timestamp()
+    # GitHub returns timestamps as 'YYYY-MM-DDTHH:MM:SSZ' in UTC, which sort
+    # the same way as the times they represent, so the cutoff can be compared
+    # against them as a plain string without parsing anything.
+    one_year_ago = today.astimezone(datetime.timezone.utc) - datetime.timedelta(days=365)
+    one_year_ago_iso = one_year_ago.strftime('%Y-%m-%dT%H:%M:%SZ')
+    # Unless the totals are wanted, only fetch the history since the cutoff.
+    # This is rounded down to the start of the day so that the queries, and so
+    # the cached responses, stay the same for a whole day.
+    if args.show_totals:
+        since = None
+    else:
+        since = one_year_ago.strftime('%Y-%m-%dT00:00:00Z')
 
     org_name = args.org[0]
-    org_repos = get_org_repos_from_name(key, org_name)
+    if args.no_cache:
+        cache = None
+    else:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        cache = shelve.open(os.path.join(CACHE_DIR, 'responses'))
+        prune_cache(cache)
+
+    try:
+        org_authors = asyncio.run(get_org_authors(key, cache, org_name, one_year_ago_iso, since))
+    finally:
+        if cache is not None:
+            cache.close()
     print('Data as of', today)
-    for repo_name, branch in org_repos.items():
+    for repo_name, authors in org_authors.items():
         print(repo_name)
-        authors = {}
-        reviews = get_reviews(key, org_name, repo_name)
-        for review in reviews:
-            if not review['author'] in authors:
-                authors[review['author']] = AuthorCounts()
-
-            authors[review['author']].total_reviews += 1
-            if review['reviewDate'] >= one_year_ago_timestamp:
-                authors[review['author']].reviews_in_last_year += 1
-
-        commits = get_commits(key, org_name, repo_name, branch)
-        for commit in commits:
-            if not commit['author'] in authors:
-                authors[commit['author']] = AuthorCounts()
-
-            authors[commit['author']].total_commits += 1
-            if commit['authoredDate'] >= one_year_ago_timestamp:
-                authors[commit['author']].commits_in_last_year += 1
-
+        # sorted() calls the key function once per author, not once per
+        # comparison, and the resulting list is used directly for printing.
+        sorted_authors = sorted(authors.items(), key=lambda item: item[1].commits_in_last_year + item[1].reviews_in_last_year, reverse=True)
         if args.csv:
-            print_csv(authors, args.show_totals)
+            print_csv(sorted_authors, args.show_totals)
         else:
-            print_authors(authors, args.show_totals)
+            print_authors(sorted_authors, args.show_totals)
 
 
 if __name__ == '__main__':